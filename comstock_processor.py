@@ -7,17 +7,417 @@ from NREL's ComStock dataset hosted on AWS S3.
 @author: nllong
 """
 
-import multiprocessing
+import base64
+import json
+import operator
+import os
+import struct
+from collections.abc import Callable
 from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import requests
+from pyarrow.fs import FileSystem, LocalFileSystem, S3FileSystem
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util import Retry
+
+# minimum set of metadata columns needed to filter the buildings and download their time series
+METADATA_COLUMNS = ["bldg_id", "in.state", "in.county_name", "in.comstock_building_type"]
+
+# location of the ComStock release as a bucket/key path for pyarrow's S3FileSystem, same as the base_url of the processor
+S3_REGION = "us-west-2"
+BASE_S3_PATH = "oedi-data-lake/nrel-pds-building-stock/end-use-load-profiles-for-us-building-stock/2024/comstock_amy2018_release_1/"
+METADATA_S3_PATH = BASE_S3_PATH + "metadata/baseline.parquet"
+
+# pre-buffering coalesces the reads of the column chunks in a row group into fewer, larger reads, which is much faster
+# over S3 where each read is a range request
+METADATA_FILE_FORMAT = ds.ParquetFileFormat(default_fragment_scan_options=ds.ParquetFragmentScanOptions(pre_buffer=True))
+
+# size of the chunks that the responses are streamed to disk in
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# number of bytes at the end of a parquet file that are requested to read its footer, larger footers need a second request
+FOOTER_PREFETCH_SIZE = 64 * 1024
+
+# metadata columns that the footer statistics are cached for, these are the columns that are filtered on
+FILTER_COLUMNS = ["in.state", "in.county_name", "in.comstock_building_type"]
+
+# hive partitioning of the consolidated time series dataset, e.g., state=CA/upgrade=0/building_type=SmallOffice
+TIME_SERIES_PARTITIONING = ds.partitioning(
+    pa.schema([("state", pa.string()), ("upgrade", pa.string()), ("building_type", pa.string())]),
+    flavor="hive",
+)
+
+# map of the DNF filter operators to the pyarrow expression operators
+FILTER_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def filters_to_expression(filters: list[tuple]) -> pc.Expression | None:
+    """Convert a list of DNF filter tuples, e.g., [("in.state", "==", "CA")], into a single pyarrow expression.
+
+    Args:
+        filters (list[tuple]): list of (column, operator, value) tuples that are all combined with AND
+
+    Returns:
+        Expression: the combined pyarrow expression, or None if there are no filters
+    """
+    if not filters:
+        return None
+
+    return reduce(operator.and_, [FILTER_OPERATORS[op](pc.field(column), value) for column, op, value in filters])
+
+
+def metadata_to_pandas(table: pa.Table) -> pd.DataFrame:
+    """Convert the metadata to a DataFrame with arrow-backed dtypes, so that the hundreds of columns are not copied and the
+    strings are not boxed into python objects.
+
+    Args:
+        table (Table): the metadata
+
+    Returns:
+        DataFrame: the metadata with pd.ArrowDtype columns
+    """
+    return table.to_pandas(types_mapper=pd.ArrowDtype, split_blocks=True)
+
+
+def metadata_filters(state: str, county_name: str, building_type: str) -> list[tuple]:
+    """Build the DNF filter tuples of the metadata. Use "All" to not filter on a field.
+
+    Args:
+        state (str): 2-letter state abbreviation
+        county_name (str): name of the county, only used if the state is also specified
+        building_type (str): type of building
+
+    Returns:
+        list[tuple]: list of (column, operator, value) tuples, e.g., [("in.state", "==", "CA")]
+    """
+    filters = []
+    if state != "All":
+        filters.append(("in.state", "==", state))
+
+    if county_name != "All":
+        if state == "All":
+            print("County is specified, but State is not. Ignoring County...")
+        else:
+            filters.append(("in.county_name", "==", f"{state}, {county_name}"))
+
+    if building_type != "All":
+        filters.append(("in.comstock_building_type", "==", building_type))
+
+    return filters
+
+
+def default_num_workers() -> int:
+    """Number of concurrent downloads. The downloads are bound by the latency of S3 and not by the cpu, so this is not based
+    on the cpu count. Set the COMSTOCK_DL_CONCURRENCY environment variable to override the default of 64.
+    """
+    return max(1, int(os.environ.get("COMSTOCK_DL_CONCURRENCY", "64")))
+
+
+def create_session(num_workers: int) -> requests.Session:
+    """Create the HTTP session that is shared by all the download threads, so that the TCP/TLS connections to S3 are kept
+    alive and reused across the buildings, instead of a new handshake for every file. The pool has a connection per thread,
+    and throttling or server errors are retried with a backoff.
+
+    Args:
+        num_workers (int): number of download threads
+
+    Returns:
+        Session: the pooled session
+    """
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=num_workers, pool_maxsize=num_workers, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+
+def write_all(fd: int, data: bytes) -> None:
+    """Write all the data to the file descriptor, since os.write can write fewer bytes than it was given.
+
+    Args:
+        fd (int): file descriptor opened for writing
+        data (bytes): data to write
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+def parse_parquet_footer(tail: bytes) -> pq.FileMetaData:
+    """Parse the metadata of a parquet file from the trailing bytes of the file, which end with the footer, its length, and
+    the PAR1 magic bytes.
+
+    Args:
+        tail (bytes): the trailing bytes of the parquet file, at least the whole footer
+
+    Returns:
+        FileMetaData: the metadata of the parquet file, including the row group statistics
+    """
+    footer_length = struct.unpack("<I", tail[-8:-4])[0]
+    # the metadata only needs the footer, so wrap it in the magic bytes as if it were a file without any data
+    return pq.read_metadata(pa.BufferReader(b"PAR1" + tail[-(footer_length + 8) :]))
+
+
+def nonzero_columns_filter(columns: list[str]) -> Callable[[pq.FileMetaData], bool]:
+    """Create a footer filter for process_building_time_series that only keeps the files which have all the columns, and
+    where the statistics show that each column has a value greater than zero, e.g., buildings that use natural gas.
+
+    Args:
+        columns (list[str]): names of the time series columns, e.g., ["out.natural_gas.total.energy_consumption"]
+
+    Returns:
+        Callable: filter that takes the metadata of a time series parquet file and returns True if the file is needed
+    """
+
+    def footer_filter(metadata: pq.FileMetaData) -> bool:
+        column_maximums = {}
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema in columns:
+                    statistics = column.statistics
+                    # without statistics, assume that the column has values
+                    maximum = statistics.max if statistics is not None and statistics.has_min_max else float("inf")
+                    column_maximums[column.path_in_schema] = max(column_maximums.get(column.path_in_schema, maximum), maximum)
+
+        return all(column_maximums.get(column, 0) > 0 for column in columns)
+
+    return footer_filter
+
+
+def unify_time_series_schemas(paths: list[Path]) -> pa.Schema:
+    """Unify the schemas of the time series files from their footers, since the buildings may not all have the same columns."""
+    return pa.unify_schemas([pq.read_schema(path) for path in paths], promote_options="permissive").remove_metadata()
+
+
+def drop_schema_fields(schema: pa.Schema, names: list[str]) -> pa.Schema:
+    """Remove the fields with the names from the schema, e.g., the columns of a time series file that are replaced by the
+    appended bldg_id and partition columns."""
+    for name in names:
+        while name in schema.names:
+            schema = schema.remove(schema.names.index(name))
+    return schema
+
+
+def conform_time_series_batch(batch: pa.RecordBatch, file_schema: pa.Schema, schema: pa.Schema, values: list[str]) -> pa.RecordBatch:
+    """Conform a record batch of a time series file to the unified file schema, and append constant string columns. Columns
+    of the file with the same name as an appended column are replaced by the appended column.
+
+    Args:
+        batch (RecordBatch): record batch read from a time series file
+        file_schema (Schema): unified schema of the time series files, missing columns are filled with nulls
+        schema (Schema): the file schema with the appended columns
+        values (list[str]): values of the appended columns, e.g., the building id
+
+    Returns:
+        RecordBatch: the record batch with the schema
+    """
+    file_schema = drop_schema_fields(file_schema, schema.names[len(schema.names) - len(values) :])
+    columns = [
+        batch.column(field.name).cast(field.type) if field.name in batch.schema.names else pa.nulls(batch.num_rows, field.type)
+        for field in file_schema
+    ]
+    columns += [pa.repeat(pa.scalar(str(value), pa.string()), batch.num_rows) for value in values]
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_response(fd: int, response: requests.Response) -> int:
+    """Stream the body of the response to the file descriptor in STREAM_CHUNK_SIZE chunks. Each chunk is written as it
+    arrives, through a memoryview of the bytes that urllib3 returns, so the body is never joined into one bytes object and
+    at most one chunk is held in memory.
+
+    Returns:
+        int: the number of bytes that were written
+    """
+    written = 0
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        write_all(fd, chunk)
+        written += len(chunk)
+
+    return written
+
+
+class MetadataStore:
+    def __init__(self, base_dir: Path, num_workers: int | None = None) -> None:
+        """MetadataStore reads the ComStock metadata and keeps the scans in memory, so that it can be shared by many
+        ComStockProcessor instances with different filters. A filter that is covered by a previous scan (e.g., the whole state
+        covers one building type in the state) is evaluated on the arrow table in memory instead of reading the parquet again.
+        The scans are dropped when the local copy of the metadata is created or changes, since they were read from another file.
+        The store also owns the pooled HTTP session that the processors share.
+
+        Args:
+            base_dir (Path): directory with the local copy of the metadata, if any, and the footer cache
+            num_workers (int, optional): number of download threads that share the session. Defaults to None, which is
+                default_num_workers().
+        """
+        self.base_dir = base_dir
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        self.num_workers = num_workers if num_workers is not None else default_num_workers()
+        self.session = create_session(self.num_workers)
+
+        # list of (filters, columns, table) of the scans that have been read, columns of None is all the columns
+        self.scans: list[tuple[list[tuple], list[str] | None, pa.Table]] = []
+        # (size, mtime) of the local metadata parquet that the scans were read from, None if they were read from S3
+        self.scans_source: tuple[int, int] | None = None
+
+    def read_footer_cache(self, filesystem: FileSystem, path: str) -> dict:
+        """Read the cached footer statistics of the metadata parquet from the `comstock_metadata.parquet.meta.json` sidecar. The
+        cache is recreated if the size or modification time of the parquet file has changed.
+
+        Args:
+            filesystem (FileSystem): pyarrow filesystem of the metadata parquet
+            path (str): path of the metadata parquet on the filesystem
+
+        Returns:
+            dict: the serialized arrow schema, row count, and min/max statistics of the FILTER_COLUMNS for each row group
+        """
+        sidecar = self.base_dir / "comstock_metadata.parquet.meta.json"
+        info = filesystem.get_file_info(path)
+        mtime = info.mtime.isoformat() if info.mtime else None
+        if sidecar.exists():
+            with open(sidecar) as file:
+                footer = json.load(file)
+            if "schema" in footer and footer["path"] == path and footer["size"] == info.size and footer["mtime"] == mtime:
+                return footer
+
+        file_metadata = pq.read_metadata(path, filesystem=filesystem)
+        schema = file_metadata.schema.to_arrow_schema()
+        row_groups = []
+        for i in range(file_metadata.num_row_groups):
+            row_group = file_metadata.row_group(i)
+            stats = {}
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema in FILTER_COLUMNS and column.statistics is not None and column.statistics.has_min_max:
+                    stats[column.path_in_schema] = {"min": column.statistics.min, "max": column.statistics.max}
+            row_groups.append({"num_rows": row_group.num_rows, "stats": stats})
+
+        footer = {
+            "path": path,
+            "size": info.size,
+            "mtime": mtime,
+            "num_rows": file_metadata.num_rows,
+            "schema": base64.b64encode(schema.serialize().to_pybytes()).decode(),
+            "index_columns": [c for c in (schema.pandas_metadata or {}).get("index_columns", []) if isinstance(c, str)],
+            "row_groups": row_groups,
+        }
+        with open(sidecar, "w") as file:
+            json.dump(footer, file)
+
+        return footer
+
+    @staticmethod
+    def footer_may_match(footer: dict, filters: list[tuple]) -> bool:
+        """Check with the cached row group statistics if any row group can contain rows that match the equality filters."""
+
+        def row_group_may_match(row_group: dict) -> bool:
+            for column, op, value in filters:
+                stats = row_group["stats"].get(column)
+                if op == "==" and stats is not None and not stats["min"] <= value <= stats["max"]:
+                    return False
+            return True
+
+        return any(row_group_may_match(row_group) for row_group in footer["row_groups"])
+
+    def filter(
+        self, state: str = "All", building_type: str = "All", county_name: str = "All", columns: list[str] | None = None
+    ) -> pa.Table:
+        """Filter the metadata by the state, county, and building type.
+
+        Args:
+            state (str, optional): 2-letter state abbreviation. Defaults to "All".
+            building_type (str, optional): type of building. Defaults to "All".
+            county_name (str, optional): name of the county. Defaults to "All".
+            columns (list[str], optional): only read these columns. Defaults to None, which reads all the columns.
+
+        Returns:
+            Table: the filtered metadata, which also includes the index columns (e.g., bldg_id) when the columns are projected
+        """
+        filters = metadata_filters(state, county_name, building_type)
+
+        local_path = self.base_dir / "comstock_metadata.parquet"
+        source = None
+        if local_path.exists():
+            stat = local_path.stat()
+            source = (stat.st_size, stat.st_mtime_ns)
+        if source != self.scans_source:
+            # the metadata parquet is not the one that the scans were read from
+            self.scans = []
+            self.scans_source = source
+
+        for scan_filters, scan_columns, scan_table in self.scans:
+            remaining_filters = [f for f in filters if f not in scan_filters]
+            if columns is None:
+                # all the columns are only in the scans that were not projected
+                has_columns = scan_columns is None
+            else:
+                has_columns = set(columns) | {c for c, _, _ in remaining_filters} <= set(scan_table.schema.names)
+            if all(f in filters for f in scan_filters) and has_columns:
+                # the scan covers the filters, so evaluate the remaining filters on the table in memory
+                table = scan_table.filter(filters_to_expression(remaining_filters)) if remaining_filters else scan_table
+                if columns is not None:
+                    index_columns = [c for c in (table.schema.pandas_metadata or {}).get("index_columns", []) if isinstance(c, str)]
+                    table = table.select(columns + [c for c in index_columns if c not in columns])
+                return table
+
+        # use the local copy of the metadata if it exists, otherwise read the metadata with range requests from S3
+        if source is not None:
+            print("Metadata parquet already exists. Reading the local file.")
+            filesystem, path = LocalFileSystem(), str(local_path.resolve())
+        else:
+            print(f"Reading metadata file from S3: s3://{METADATA_S3_PATH}")
+            filesystem, path = S3FileSystem(anonymous=True, region=S3_REGION), METADATA_S3_PATH
+
+        footer = self.read_footer_cache(filesystem, path)
+        schema = pa.ipc.read_schema(pa.py_buffer(base64.b64decode(footer["schema"])))
+        if not self.footer_may_match(footer, filters):
+            # none of the row groups can match, so skip reading the metadata parquet
+            print("No buildings in the metadata match the filters.")
+            table = schema.empty_table()
+            if columns is not None:
+                table = table.select(columns + [c for c in footer["index_columns"] if c not in columns])
+        else:
+            dataset = ds.dataset(path, format=METADATA_FILE_FORMAT, filesystem=filesystem, schema=schema)
+
+            # the index columns (e.g., bldg_id) need to be read explicitly when projecting, otherwise they are dropped
+            read_columns = columns
+            if columns is not None:
+                read_columns = columns + [c for c in footer["index_columns"] if c not in columns]
+
+            # read, pushing the filters and the column projection down to pyarrow so that only the matching row groups
+            # and requested column chunks are decoded
+            table = dataset.to_table(columns=read_columns, filter=filters_to_expression(filters), use_threads=True)
+
+        self.scans.append((filters, columns, table))
+        return table
 
 
 class ComStockProcessor:
-    def __init__(self, state: str, county_name: str, building_type: str, upgrade: str, base_dir: Path) -> None:
+    def __init__(
+        self,
+        state: str,
+        county_name: str,
+        building_type: str,
+        upgrade: str,
+        base_dir: Path,
+        metadata_store: MetadataStore | None = None,
+    ) -> None:
         """ComStockProcess class helps users download metadata and time series data from the ComStock dataset.
 
         Args:
@@ -26,6 +426,8 @@ class ComStockProcessor:
             building_type (str): type of building
             upgrade (str): upgrade identifier from ComStock, e.g., 0 = baseline
             base_dir (Path): directory to save the downloaded ComStock files
+            metadata_store (MetadataStore, optional): store to read the metadata from, share it between processors to reuse
+                the metadata that has been read and the HTTP connections. Defaults to None, which creates a new store.
         """
         self.state = state
         self.county_name = county_name
@@ -44,98 +446,487 @@ class ComStockProcessor:
         self.metadata_url = self.base_url + "metadata"
         self.time_series_url = self.base_url + "timeseries_individual_buildings"
 
-    def download_file(self, url: str, save_path: Path) -> None:
-        response = requests.get(url, timeout=300)
-        if response.status_code == 200:
-            with open(save_path, "wb") as file:
-                file.write(response.content)
-            # TODO: need to create valid logger so that we don't always show these messages
-            # tqdm.write(f"File downloaded successfully: {save_path}")
-        else:
+        # the metadata store and its pooled HTTP session can be shared by many processors
+        self.metadata_store = metadata_store if metadata_store is not None else MetadataStore(base_dir)
+        self.num_workers = self.metadata_store.num_workers
+        self.session = self.metadata_store.session
+
+    def download_file(self, url: str, save_path: Path) -> bool:
+        """Download a file with a single GET over the shared session. The response is streamed to disk instead of being
+        held in memory, and the number of bytes written is checked against the Content-Length of the response so that a
+        truncated file is not kept.
+
+        Args:
+            url (str): url of the file to download
+            save_path (Path): path to save the file
+
+        Returns:
+            bool: True if the file was downloaded
+        """
+        # the file is opened once, without python's buffering, and the chunks are written straight into it
+        fd = None
+        downloaded = False
+        try:
+            with self.session.get(url, stream=True, timeout=300) as response:
+                if response.status_code != 200:
+                    tqdm.write(f"Failed to download file: {url}")
+                    return False
+
+                etag = response.headers.get("ETag")
+                # the Content-Length is the size of the encoded body, so it can only be compared when the body isn't decoded
+                size = None
+                if "Content-Length" in response.headers and "Content-Encoding" not in response.headers:
+                    size = int(response.headers["Content-Length"])
+
+                fd = os.open(save_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+                written = write_response(fd, response)
+            downloaded = size is None or written == size
+        except requests.RequestException:
+            pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+        if not downloaded:
+            # don't leave a partial file behind, otherwise it would be treated as already downloaded
+            save_path.unlink(missing_ok=True)
             tqdm.write(f"Failed to download file: {url}")
+            return False
+
+        # keep the version of the object next to the file, so that the cached file can be validated later
+        etag_path = self.etag_path(save_path)
+        if etag is not None:
+            etag_path.write_text(etag)
+        else:
+            etag_path.unlink(missing_ok=True)
+
+        # TODO: need to create valid logger so that we don't always show these messages
+        # tqdm.write(f"File downloaded successfully: {save_path}")
+        return True
+
+    @staticmethod
+    def etag_path(save_path: Path) -> Path:
+        """Return the path of the file with the ETag of a downloaded file."""
+        return save_path.with_suffix(save_path.suffix + ".etag")
+
+    def is_cached_file_current(self, url: str, save_path: Path) -> bool:
+        """Check with a HEAD request if a downloaded file is still the same version as the object online, by comparing
+        the ETag of the object to the one that was saved when the file was downloaded. Files without a saved ETag, e.g.,
+        from a run before the ETags were saved, are treated as stale since their version is unknown. Files that can't be
+        checked because the request failed are treated as current.
 
-    def process_metadata(self, save_dir: Path) -> pd.DataFrame:
-        """Download (if needed) and process the comstock metadata. This process will only download if it is not already persisted.
-        The method can take a few minutes since the datafile can be heavy.
+        Args:
+            url (str): url of the file
+            save_path (Path): path of the downloaded file
+
+        Returns:
+            bool: False if the object online has changed since the file was downloaded
+        """
+        etag_path = self.etag_path(save_path)
+        if not etag_path.exists():
+            return False
+        try:
+            response = self.session.head(url, timeout=300)
+        except requests.RequestException:
+            tqdm.write(f"Failed to validate file: {url}")
+            return True
+        if response.status_code != 200:
+            tqdm.write(f"Failed to validate file: {url}")
+            return True
+        etag = response.headers.get("ETag")
+        return etag is None or etag == etag_path.read_text()
+
+    def fetch_footer(self, url: str, footer_path: Path) -> pq.FileMetaData | None:
+        """Fetch only the footer of a remote parquet file with suffix range requests, and cache the footer to disk so that
+        later calls don't need to request it again.
+
+        Args:
+            url (str): url of the parquet file
+            footer_path (Path): path to cache the footer bytes
+
+        Returns:
+            FileMetaData: the metadata of the parquet file, or None if the footer could not be downloaded or parsed
+        """
+        if footer_path.exists():
+            try:
+                return parse_parquet_footer(footer_path.read_bytes())
+            except (struct.error, OSError, pa.ArrowInvalid):
+                # the cached footer is corrupt, request it again
+                footer_path.unlink()
+
+        try:
+            response = self.session.get(url, headers={"Range": f"bytes=-{FOOTER_PREFETCH_SIZE}"}, timeout=300)
+            if response.status_code == 206 and len(response.content) >= 8:
+                # request the whole footer if it is larger than the prefetch
+                footer_length = struct.unpack("<I", response.content[-8:-4])[0]
+                if len(response.content) < footer_length + 8:
+                    response = self.session.get(url, headers={"Range": f"bytes=-{footer_length + 8}"}, timeout=300)
+            if response.status_code not in (200, 206):
+                tqdm.write(f"Failed to download footer: {url}")
+                return None
+
+            tail = response.content
+            metadata = parse_parquet_footer(tail)
+        except (requests.RequestException, struct.error, OSError, pa.ArrowInvalid):
+            # a short or non-parquet tail, or a failed request, leave the decision to the normal download
+            tqdm.write(f"Failed to download footer: {url}")
+            return None
+
+        # only cache footers that could be parsed
+        footer_length = struct.unpack("<I", tail[-8:-4])[0]
+        footer_path.parent.mkdir(parents=True, exist_ok=True)
+        footer_path.write_bytes(tail[-(footer_length + 8) :])
+
+        return metadata
+
+    def selected_metadata_path(self, save_dir: Path, state: str, county_name: str, building_type: str) -> Path:
+        """Path of the persisted metadata that has been filtered by the state, county, and building type."""
+        return save_dir / f"{state}-{county_name}-{building_type}-{self.upgrade}-selected_metadata.parquet"
+
+    def metadata_filters(self) -> list[tuple]:
+        """Build the DNF filter tuples from the classes "constraints", see metadata_filters."""
+        return metadata_filters(self.state, self.county_name, self.building_type)
+
+    def metadata_expression(self) -> pc.Expression | None:
+        """Build the pyarrow expression from the classes "constraints", e.g., `pc.field("in.state") == "CA"`, or None if
+        there are no constraints. The expression can be passed to pyarrow readers, e.g., `pq.read_table(path, filters=...)`.
+        """
+        return filters_to_expression(self.metadata_filters())
+
+    def find_cached_superset(self, save_dir: Path) -> Path | None:
+        """Find a persisted metadata selection that covers the classes "constraints", e.g., DE-All-All covers DE-All-SmallOffice.
+
+        Args:
+            save_dir (Path): path where the metadata selections are saved
+
+        Returns:
+            Path: path to the persisted superset selection, or None if there is not one
+        """
+        states = [self.state, "All"] if self.state != "All" else ["All"]
+        building_types = [self.building_type, "All"] if self.building_type != "All" else ["All"]
+        for state in states:
+            # the county is only a constraint if the state is also a constraint
+            county_names = [self.county_name, "All"] if state != "All" and self.county_name != "All" else ["All"]
+            for county_name in county_names:
+                for building_type in building_types:
+                    if (state, county_name, building_type) == (self.state, self.county_name, self.building_type):
+                        continue
+                    path = self.selected_metadata_path(save_dir, state, county_name, building_type)
+                    if path.exists():
+                        return path
+
+        return None
+
+    def process_metadata(self, save_dir: Path, columns: list[str] | None = None, save_csv: bool = False) -> pd.DataFrame:
+        """Read and process the comstock metadata. The metadata is read directly from S3, which only fetches the parquet footer
+        and the row groups and columns that match the filters. If a full copy of the metadata already exists locally in
+        `comstock_metadata.parquet` in the base_dir of the metadata store, then that file is read instead. The metadata store
+        can be shared by processors with different filters, so the metadata is not read again. The filtered result is
+        persisted, and is not read again if it already exists. If a persisted result for a broader filter exists (e.g., the
+        whole state), then that result is filtered instead of reading the metadata parquet.
 
         Args:
             save_dir (Path): path to save the metadata
+            columns (list[str], optional): only read these columns from the metadata, e.g., METADATA_COLUMNS. Defaults to None,
+                which reads all the columns. A projected result is not saved to the selected metadata parquet.
+            save_csv (bool, optional): also save the selected metadata as a csv when it is created. Defaults to False.
 
         Returns:
             DataFrame: the resulting metadata filtered by the classes "constraints".
         """
-        # check if the parquet already exists, don't download it again if so, but give a warning
-        if (save_dir / "comstock_metadata.parquet").exists():
-            print("Metadata parquet already exists. Skipping download.")
+        # check if the parquet already exists, don't create it again if so, but give a warning
+        output_parquet = self.selected_metadata_path(save_dir, self.state, self.county_name, self.building_type)
+        if output_parquet.exists():
+            print(f"Selected metadata already exists. Skipping creation. Delete {output_parquet} if you want to save again.")
+            meta_df = metadata_to_pandas(pq.read_table(output_parquet, columns=columns))
+
+            return meta_df
+
+        superset_parquet = self.find_cached_superset(save_dir)
+        if superset_parquet is not None:
+            # filter the broader selection that is already on disk instead of reading the metadata parquet. The expression is
+            # pushed into the parquet reader, and any residual predicate is evaluated on the arrow arrays.
+            print(f"Filtering the metadata from the existing selection: {superset_parquet}")
+            table = pq.read_table(superset_parquet, columns=columns, filters=self.metadata_expression(), pre_buffer=True, use_threads=True)
+            meta_df = metadata_to_pandas(table)
         else:
-            download_file = f"{self.metadata_url}/baseline.parquet"
-            print(f"Downloading metadata file: {download_file}")
-            self.download_file(download_file, save_path=save_dir / "comstock_metadata.parquet")
+            # the store serves the filters from the scans that it holds in memory, or reads the metadata parquet
+            table = self.metadata_store.filter(self.state, self.building_type, self.county_name, columns=columns)
+            meta_df = metadata_to_pandas(table).reset_index(drop=False)
 
-        # check if the csv already exists, don't create it again if so, but give a warning
-        output_csv = save_dir / f"{self.state}-{self.county_name}-{self.building_type}-{self.upgrade}-selected_metadata.csv"
-        if output_csv.exists():
-            print(f"Metadata csv already exists. Skipping creation. Delete {output_csv} if you want to save again.")
-            meta_df = pd.read_csv(output_csv)
+        if columns is not None:
+            # return only the requested columns, in the requested order. Don't save the projected metadata, the parquet
+            # needs all the columns so that it can be reused by any later call
+            return meta_df[columns]
 
-            return meta_df
+        # save to parquet, which keeps the dtypes and is much faster to read back than a csv
+        meta_df.to_parquet(output_parquet, index=False, compression="zstd", row_group_size=50_000)
+        if save_csv:
+            meta_df.to_csv(output_parquet.with_suffix(".csv"), index=False)
 
-        # filter
-        filters = []
-        if self.state != "All":
-            filters.append(("in.state", "==", self.state))
+        return meta_df
 
-        if self.county_name != "All":
-            if self.state == "All":
-                print("County is specified, but State is not. Ignoring County...")
-            else:
-                filters.append(("in.county_name", "==", f"{self.state}, {self.county_name}"))
+    def manifest_path(self, save_dir: Path) -> Path:
+        """Return the path of the manifest of the time series files that were downloaded to save_dir for the upgrade."""
+        return save_dir / f"manifest-upgrade-{self.upgrade}.json"
 
-        if self.building_type != "All":
-            filters.append(("in.comstock_building_type", "==", self.building_type))
+    def read_manifest(self, save_dir: Path) -> dict[str, str]:
+        """Read the building ids and file names of the time series files that were downloaded to save_dir.
 
-        # read
-        meta_df = pd.read_parquet(save_dir / "comstock_metadata.parquet", filters=None if len(filters) == 0 else filters)
-        meta_df = meta_df.reset_index(drop=False)
+        Args:
+            save_dir (Path): path of the time series files
 
-        # save to csv
-        meta_df.to_csv(output_csv, index=False)
+        Returns:
+            dict: file name of the time series file of each building id, empty if there is no manifest yet
+        """
+        manifest_path = self.manifest_path(save_dir)
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        if manifest.get("upgrade") != self.upgrade:
+            return {}
+        return dict(zip(manifest["ids"], manifest["paths"]))
+
+    def write_manifest(self, save_dir: Path, files: dict[str, str]) -> None:
+        """Write the building ids and file names of the time series files that were downloaded to save_dir."""
+        manifest = {"upgrade": self.upgrade, "ids": list(files), "paths": list(files.values())}
+        with open(self.manifest_path(save_dir), "w") as file:
+            json.dump(manifest, file)
+
+    def process_building_time_series(
+        self,
+        data_frame,
+        save_dir: Path,
+        build_dataset: bool = False,
+        build_ipc: bool = False,
+        footer_filter: Callable[[pq.FileMetaData], bool] | None = None,
+        validate_cache: bool = False,
+    ) -> tuple[list[Path], list[str]]:
+        """Pull the latest time series data from the BuildStock data files online using parallel execution. The downloaded
+        files are recorded in a manifest in save_dir, see manifest_path. When the manifest already covers all the buildings,
+        the paths are returned from it without checking the files on disk.
 
-        return meta_df
+        Args:
+            data_frame (DataFrame): metadata of the buildings to download, needs the bldg_id and in.state columns
+            save_dir (Path): path to save the time series files
+            build_dataset (bool, optional): also consolidate the downloaded files into a partitioned dataset in
+                `save_dir / "dataset"`, see write_time_series_dataset. Defaults to False.
+            build_ipc (bool, optional): also consolidate the downloaded files into an Arrow IPC file per state in `save_dir`,
+                see write_time_series_ipc. Defaults to False.
+            footer_filter (Callable, optional): only download the files where the filter returns True for the metadata
+                of the file, e.g., nonzero_columns_filter(["out.natural_gas.total.energy_consumption"]). Only the footers
+                are requested to evaluate the filter, and they are cached in `save_dir / "footers"`. Defaults to None.
+            validate_cache (bool, optional): check the files that were already downloaded against the objects online with
+                a HEAD request each, and download the files again if the objects have changed or if the files have no saved
+                ETag. Defaults to False.
 
-    def process_building_time_series(self, data_frame, save_dir: Path) -> None:
-        """Pull the latest time series data from the BuildStock data files online using parallel execution."""
-        num_workers = max(1, multiprocessing.cpu_count() - 1)
-        print(f"Number of workers: {num_workers}")
+        Returns:
+            tuple: list of the paths and list of the building ids of the time series files, without the buildings that
+                were skipped by the footer_filter
+        """
+        print(f"Number of workers: {self.num_workers}")
 
-        def download_task(row):
-            building_id = str(row["bldg_id"])
+        def download_task(building: tuple[str, str]):
+            building_id, state = building
 
-            # Check if file already exists
             save_path = save_dir / f"bldg_id-{building_id}-upgrade-{self.upgrade}.parquet"
-            if save_path.exists():
-                return save_path, building_id
-
             building_time_series_file = (
-                f"{self.time_series_url}/by_state/upgrade={self.upgrade}/state={row['in.state']}/{building_id}-{self.upgrade}.parquet"
+                f"{self.time_series_url}/by_state/upgrade={self.upgrade}/state={state}/{building_id}-{self.upgrade}.parquet"
             )
-            self.download_file(building_time_series_file, save_path)
-            return save_path, building_id
 
-        data_rows = [row for _, row in data_frame.iterrows()]
-        with ThreadPoolExecutor(max_workers=num_workers) as executor:
-            results = list(tqdm(executor.map(download_task, data_rows), total=len(data_rows)))
+            cached = save_path.name in existing_files
+            if cached and validate_cache and not self.is_cached_file_current(building_time_series_file, save_path):
+                # the object was published again, so the cached file and footer are stale. They are removed right away,
+                # so that they aren't left behind when the footer_filter skips the building
+                existing_files.discard(save_path.name)
+                manifest.pop(building_id, None)
+                save_path.unlink(missing_ok=True)
+                self.etag_path(save_path).unlink(missing_ok=True)
+                (save_dir / "footers" / f"{save_path.name}.footer").unlink(missing_ok=True)
+
+            if footer_filter is not None:
+                # decide from the footer of the file if it is needed, before downloading the whole file
+                metadata = None
+                if save_path.name in existing_files:
+                    try:
+                        metadata = pq.read_metadata(save_path)
+                    except (OSError, pa.ArrowInvalid):
+                        # the cached file is corrupt, e.g., truncated, so it is downloaded again
+                        existing_files.discard(save_path.name)
+                if save_path.name not in existing_files:
+                    metadata = self.fetch_footer(building_time_series_file, save_dir / "footers" / f"{save_path.name}.footer")
+                if metadata is not None and not footer_filter(metadata):
+                    return None
+
+            # Check if file already exists
+            if save_path.name in existing_files:
+                return save_path, building_id, True
+
+            downloaded = self.download_file(building_time_series_file, save_path)
+            return save_path, building_id, downloaded
+
+        if data_frame.empty:
+            return [], []
+
+        # only the building id and state are needed, so read the two columns as arrays instead of creating a row per building
+        building_ids = data_frame["bldg_id"].to_numpy(dtype=str).tolist()
+        manifest = self.read_manifest(save_dir)
+
+        # the footer filter and the validation have to look at each file, so the manifest can't be used to skip them
+        if footer_filter is None and not validate_cache and all(building_id in manifest for building_id in building_ids):
+            paths = [save_dir / manifest[building_id] for building_id in building_ids]
+            if build_dataset:
+                self.write_time_series_dataset(data_frame, paths, building_ids, save_dir / "dataset")
+            if build_ipc:
+                self.write_time_series_ipc(data_frame, paths, building_ids, save_dir)
+            return paths, building_ids
+
+        # list the directory once instead of checking if each building's file exists
+        existing_files = {entry.name for entry in os.scandir(save_dir) if entry.is_file() and entry.name.endswith(".parquet")}
+
+        states = data_frame["in.state"].to_numpy(dtype=str).tolist()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            results = list(tqdm(executor.map(download_task, zip(building_ids, states)), total=len(building_ids)))
+        results = [result for result in results if result is not None]
+
+        # add the files that are on disk to the manifest of the previous runs, and drop the ones that failed to download
+        for save_path, building_id, on_disk in results:
+            if on_disk:
+                manifest[building_id] = save_path.name
+            else:
+                manifest.pop(building_id, None)
+        self.write_manifest(save_dir, manifest)
+        results = [(save_path, building_id) for save_path, building_id, _ in results]
 
         # break out the paths and building_ids
         paths, building_ids = zip(*results) if results else ([], [])
+        if build_dataset:
+            self.write_time_series_dataset(data_frame, list(paths), list(building_ids), save_dir / "dataset")
+        if build_ipc:
+            self.write_time_series_ipc(data_frame, list(paths), list(building_ids), save_dir)
+
         return list(paths), list(building_ids)
 
+    def write_time_series_dataset(self, data_frame: pd.DataFrame, paths: list[Path], building_ids: list[str], dataset_dir: Path) -> Path:
+        """Consolidate the per-building time series files into one parquet dataset that is partitioned by the state, upgrade,
+        and building type. The files are streamed as record batches, so they are never all in memory at once. The dataset
+        can then be read with column projection and row group pruning, e.g.,
+        `ComStockProcessor.time_series_dataset(dataset_dir).to_table(filter=pc.field("building_type") == "SmallOffice")`.
+
+        Args:
+            data_frame (DataFrame): metadata of the buildings, needs the bldg_id, in.state, and in.comstock_building_type columns
+            paths (list[Path]): paths of the time series files, from process_building_time_series
+            building_ids (list[str]): building ids of the time series files, from process_building_time_series
+            dataset_dir (Path): directory to write the dataset to, existing partitions that are written to are replaced
+
+        Returns:
+            Path: the dataset directory
+        """
+        building_types = dict(zip(data_frame["bldg_id"].to_numpy(dtype=str).tolist(), data_frame["in.comstock_building_type"]))
+        states = dict(zip(data_frame["bldg_id"].to_numpy(dtype=str).tolist(), data_frame["in.state"]))
+        files = [(Path(path), building_id) for path, building_id in zip(paths, building_ids) if Path(path).exists()]
+        if not files:
+            return dataset_dir
+
+        # the bldg_id and partition columns are added from the metadata, so they replace any columns of the files with those names
+        file_schema = drop_schema_fields(
+            unify_time_series_schemas([path for path, _ in files]), ["bldg_id", *TIME_SERIES_PARTITIONING.schema.names]
+        )
+        schema = pa.unify_schemas([file_schema.append(pa.field("bldg_id", pa.string())), TIME_SERIES_PARTITIONING.schema])
+
+        def record_batches():
+            for path, building_id in files:
+                for batch in pq.ParquetFile(path).iter_batches():
+                    values = [building_id, states[building_id], self.upgrade, building_types[building_id]]
+                    yield conform_time_series_batch(batch, file_schema, schema, values)
+
+        ds.write_dataset(
+            record_batches(),
+            base_dir=dataset_dir,
+            schema=schema,
+            format="parquet",
+            partitioning=TIME_SERIES_PARTITIONING,
+            existing_data_behavior="delete_matching",
+        )
+
+        return dataset_dir
+
+    @staticmethod
+    def time_series_dataset(dataset_dir: Path) -> ds.Dataset:
+        """Open the consolidated time series dataset that was written by write_time_series_dataset."""
+        return ds.dataset(dataset_dir, format="parquet", partitioning=TIME_SERIES_PARTITIONING)
+
+    def write_time_series_ipc(self, data_frame: pd.DataFrame, paths: list[Path], building_ids: list[str], save_dir: Path) -> list[Path]:
+        """Consolidate the per-building time series files into one uncompressed Arrow IPC (Feather v2) file per state, named
+        `{state}-{upgrade}.arrow`, with a bldg_id column added. The per-building files are kept, but repeated reads are much
+        faster from the IPC file since it can be memory mapped without decoding, see read_time_series_ipc.
+
+        Args:
+            data_frame (DataFrame): metadata of the buildings, needs the bldg_id and in.state columns
+            paths (list[Path]): paths of the time series files, from process_building_time_series
+            building_ids (list[str]): building ids of the time series files, from process_building_time_series
+            save_dir (Path): directory to write the IPC files to
+
+        Returns:
+            list[Path]: paths of the IPC files
+        """
+        states = dict(zip(data_frame["bldg_id"].to_numpy(dtype=str).tolist(), data_frame["in.state"]))
+        files_by_state = {}
+        for path, building_id in zip(paths, building_ids):
+            if Path(path).exists():
+                files_by_state.setdefault(str(states[building_id]), []).append((Path(path), building_id))
+
+        ipc_paths = []
+        for state, files in files_by_state.items():
+            # the bldg_id column is added from the metadata, so it replaces a bldg_id column of the files
+            file_schema = drop_schema_fields(unify_time_series_schemas([path for path, _ in files]), ["bldg_id"])
+            schema = file_schema.append(pa.field("bldg_id", pa.string()))
+
+            ipc_path = save_dir / f"{state}-{self.upgrade}.arrow"
+            with pa.OSFile(str(ipc_path), "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+                for path, building_id in files:
+                    for batch in pq.ParquetFile(path).iter_batches():
+                        writer.write_batch(conform_time_series_batch(batch, file_schema, schema, [building_id]))
+            ipc_paths.append(ipc_path)
+
+        return ipc_paths
+
+    @staticmethod
+    def iter_timeseries_batches(paths: list[Path], columns: list[str] | None = None, batch_size: int = 65536) -> pa.RecordBatchReader:
+        """Stream the record batches of the per-building time series files, instead of reading each file into a DataFrame
+        and concatenating them. The files are scanned as one dataset with the unified schema of the files, so the missing
+        columns of a building are filled with nulls. Requested columns that are in none of the files, e.g., when every
+        download failed, are read as null columns, so the reader is empty instead of failing when there are no files.
+
+        Args:
+            paths (list[Path]): paths of the time series files, from process_building_time_series
+            columns (list[str], optional): only read these columns. Defaults to None, which reads all the columns.
+            batch_size (int, optional): maximum number of rows in a record batch. Defaults to 65536.
+
+        Returns:
+            RecordBatchReader: reader of the record batches, e.g., use read_all() to get a table
+        """
+        paths = [str(path) for path in paths if Path(path).exists()]
+        schema = unify_time_series_schemas(paths) if paths else pa.schema([])
+        # the requested columns that are in none of the files (e.g., when every download failed) are read as nulls
+        for column in columns or []:
+            if column not in schema.names:
+                schema = schema.append(pa.field(column, pa.null()))
+        dataset = ds.dataset(paths, schema=schema, format="parquet")
+        return dataset.scanner(columns=columns, batch_size=batch_size).to_reader()
+
+    @staticmethod
+    def read_time_series_ipc(ipc_path: Path) -> pa.Table:
+        """Read an IPC file that was written by write_time_series_ipc. The file is memory mapped, so the table is zero-copy."""
+        with pa.memory_map(str(ipc_path)) as source:
+            return pa.ipc.open_file(source).read_all()
+
 
 def main() -> None:
-    # Settings for modification
-    state = "CA"
-    county_name = "All"
-    building_type = "All"
+    # Settings for modification, add more (state, county_name, building_type) selections as needed. The selections share
+    # the metadata store, so the metadata and the HTTP connections are reused between them.
+    selections = [("CA", "All", "All")]
     upgrade = "0"
 
     base_dir = Path().resolve() / "datasets" / "comstock"
@@ -144,10 +935,15 @@ def main() -> None:
         if not d.exists():
             d.mkdir(parents=True, exist_ok=True)
 
-    processor = ComStockProcessor(state, county_name, building_type, upgrade, base_dir)
-    meta_df = processor.process_metadata(save_dir=base_dir)
+    metadata_store = MetadataStore(base_dir)
+    # the io threads fetch the column chunks of the metadata, allow at least as many concurrent reads as downloads. This is
+    # process-wide, so it is set by the script instead of the store
+    pa.set_io_thread_count(max(pa.io_thread_count(), metadata_store.num_workers))
+    for state, county_name, building_type in selections:
+        processor = ComStockProcessor(state, county_name, building_type, upgrade, base_dir, metadata_store=metadata_store)
+        meta_df = processor.process_metadata(save_dir=base_dir)
 
-    processor.process_building_time_series(meta_df, save_dir=timeseries_save_dir)
+        processor.process_building_time_series(meta_df, save_dir=timeseries_save_dir)
 
 
 if __name__ == "__main__":
@@ -8,9 +8,20 @@ to test the functionality end-to-end without mocks.
 from pathlib import Path
 
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import pytest
+import requests
+from pyarrow.fs import LocalFileSystem
 
-from comstock_processor import ComStockProcessor
+from comstock_processor import (
+    FOOTER_PREFETCH_SIZE,
+    METADATA_COLUMNS,
+    ComStockProcessor,
+    MetadataStore,
+    nonzero_columns_filter,
+    parse_parquet_footer,
+)
 
 
 @pytest.fixture
@@ -46,6 +57,24 @@ def california_processor(test_data_dir):
     return ComStockProcessor(state="CA", county_name="All", building_type="All", upgrade="0", base_dir=test_data_dir)
 
 
+@pytest.fixture
+def local_metadata_dir(tmp_path):
+    """Create a small local copy of the metadata, which the metadata store reads instead of the metadata on S3."""
+    metadata = pd.DataFrame(
+        {
+            "bldg_id": [3, 8, 15, 16, 23, 42, 57, 60],
+            "in.state": ["CA"] * 4 + ["DE"] * 4,
+            "in.county_name": ["CA, Los Angeles", "CA, Los Angeles", "CA, Alameda", "CA, Alameda"] + ["DE, Kent"] * 4,
+            "in.comstock_building_type": ["SmallOffice", "MediumOffice"] * 4,
+            "in.sqft": [1000.0, 2000.0, 3000.0, 4000.0, 5000.0, 6000.0, 7000.0, 8000.0],
+        }
+    ).set_index("bldg_id")
+    # one row group per state, so that the row group statistics can rule out a state
+    metadata.to_parquet(tmp_path / "comstock_metadata.parquet", row_group_size=4)
+
+    return tmp_path
+
+
 class TestComStockProcessor:
     """Test cases for ComStockProcessor class."""
 
@@ -70,19 +99,177 @@ class TestComStockProcessor:
         assert processor.metadata_url == expected_base + "metadata"
         assert processor.time_series_url == expected_base + "timeseries_individual_buildings"
 
+    @pytest.mark.unit
+    def test_download_concurrency(self, test_data_dir, monkeypatch):
+        """Test that the number of download workers is configurable and sizes the connection pool."""
+        monkeypatch.setenv("COMSTOCK_DL_CONCURRENCY", "16")
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=test_data_dir)
+
+        assert processor.num_workers == 16
+        assert processor.session.get_adapter("https://oedi-data-lake.s3.amazonaws.com")._pool_maxsize == 16
+
+    @pytest.mark.unit
+    def test_metadata_expression(self, test_data_dir):
+        """Test that the constraints are combined into a single pyarrow expression."""
+        processor = ComStockProcessor(
+            state="CA", county_name="Los Angeles", building_type="MediumOffice", upgrade="0", base_dir=test_data_dir
+        )
+        expected = (
+            (pc.field("in.state") == "CA")
+            & (pc.field("in.county_name") == "CA, Los Angeles")
+            & (pc.field("in.comstock_building_type") == "MediumOffice")
+        )
+        assert processor.metadata_expression().equals(expected)
+
+        # no constraints, no expression
+        processor = ComStockProcessor(state="All", county_name="All", building_type="All", upgrade="0", base_dir=test_data_dir)
+        assert processor.metadata_expression() is None
+
+    @pytest.mark.unit
+    def test_metadata_store_projected_scan_all_columns(self, local_metadata_dir):
+        """Test that a projected scan is not reused for a later call that needs all the columns."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=local_metadata_dir)
+
+        projected_df = processor.process_metadata(save_dir=local_metadata_dir, columns=["bldg_id", "in.state"])
+        assert list(projected_df.columns) == ["bldg_id", "in.state"]
+
+        metadata_df = processor.process_metadata(save_dir=local_metadata_dir)
+        assert {*METADATA_COLUMNS, "in.sqft"} <= set(metadata_df.columns)
+        assert len(metadata_df) == 4
+
+        # the saved selection has all the columns too
+        output_parquet = processor.selected_metadata_path(local_metadata_dir, "DE", "All", "All")
+        assert list(pd.read_parquet(output_parquet).columns) == list(metadata_df.columns)
+
+    @pytest.mark.unit
+    def test_metadata_store_reuses_scans(self, local_metadata_dir):
+        """Test that the filters which are covered by a previous scan are evaluated in memory."""
+        store = MetadataStore(local_metadata_dir)
+
+        table = store.filter(state="CA")
+        assert table.num_rows == 4
+        assert len(store.scans) == 1
+
+        # narrower filters and projections of the scan don't read the metadata parquet again
+        table = store.filter(state="CA", building_type="SmallOffice")
+        assert table.column("in.comstock_building_type").to_pylist() == ["SmallOffice", "SmallOffice"]
+        table = store.filter(state="CA", county_name="Alameda", columns=["in.sqft"])
+        assert table.column("in.sqft").to_pylist() == [3000.0, 4000.0]
+        assert "bldg_id" in table.column_names
+        assert len(store.scans) == 1
+
+        # a broader filter is not covered
+        assert store.filter().num_rows == 8
+        assert len(store.scans) == 2
+
+    @pytest.mark.unit
+    def test_metadata_store_drops_stale_scans(self, local_metadata_dir):
+        """Test that the scans are dropped when the local metadata parquet changes."""
+        store = MetadataStore(local_metadata_dir)
+        assert store.filter(state="CA").num_rows == 4
+
+        # replace the metadata with one that has a single building in CA
+        metadata_path = local_metadata_dir / "comstock_metadata.parquet"
+        metadata = pd.read_parquet(metadata_path).iloc[3:]
+        metadata.to_parquet(metadata_path)
+
+        assert store.filter(state="CA").num_rows == 1
+        assert len(store.scans) == 1
+
+    @pytest.mark.unit
+    def test_metadata_store_footer_cache(self, local_metadata_dir):
+        """Test that the footer statistics are cached in the sidecar and rule out the filters that can't match."""
+        store = MetadataStore(local_metadata_dir)
+        path = str((local_metadata_dir / "comstock_metadata.parquet").resolve())
+
+        footer = store.read_footer_cache(LocalFileSystem(), path)
+        assert (local_metadata_dir / "comstock_metadata.parquet.meta.json").exists()
+        assert footer["num_rows"] == 8
+        assert footer["index_columns"] == ["bldg_id"]
+        assert [row_group["stats"]["in.state"] for row_group in footer["row_groups"]] == [
+            {"min": "CA", "max": "CA"},
+            {"min": "DE", "max": "DE"},
+        ]
+
+        assert MetadataStore.footer_may_match(footer, [("in.state", "==", "DE")])
+        assert not MetadataStore.footer_may_match(footer, [("in.state", "==", "NY")])
+        assert not MetadataStore.footer_may_match(footer, [("in.state", "==", "DE"), ("in.county_name", "==", "CA, Alameda")])
+
+        # a filter that can't match returns an empty table with the schema of the metadata
+        table = store.filter(state="NY")
+        assert table.num_rows == 0
+        assert "in.sqft" in table.column_names
+
+    @pytest.mark.unit
+    def test_find_cached_superset(self, local_metadata_dir):
+        """Test that a narrower selection is filtered from a broader selection that was already saved."""
+        processor = ComStockProcessor(
+            state="CA", county_name="Alameda", building_type="SmallOffice", upgrade="0", base_dir=local_metadata_dir
+        )
+        assert processor.find_cached_superset(local_metadata_dir) is None
+
+        state_processor = ComStockProcessor(state="CA", county_name="All", building_type="All", upgrade="0", base_dir=local_metadata_dir)
+        state_processor.process_metadata(save_dir=local_metadata_dir)
+        superset_parquet = processor.find_cached_superset(local_metadata_dir)
+        assert superset_parquet == state_processor.selected_metadata_path(local_metadata_dir, "CA", "All", "All")
+
+        metadata_df = processor.process_metadata(save_dir=local_metadata_dir)
+        assert metadata_df["bldg_id"].tolist() == [15]
+
+        # selections of other states don't cover the filters
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="SmallOffice", upgrade="0", base_dir=local_metadata_dir)
+        assert processor.find_cached_superset(local_metadata_dir) is None
+
+    @pytest.mark.unit
+    def test_nonzero_columns_filter(self, tmp_path):
+        """Test that the footer filter is evaluated on the metadata parsed from the tail of a time series file."""
+        path = tmp_path / "bldg_id-1-upgrade-0.parquet"
+        pd.DataFrame(
+            {
+                "out.electricity.total.energy_consumption": [1.0, 2.0, 3.0, 4.0],
+                "out.natural_gas.total.energy_consumption": [0.0, 0.0, 0.0, 0.0],
+            }
+        ).to_parquet(path)
+
+        metadata = parse_parquet_footer(path.read_bytes()[-FOOTER_PREFETCH_SIZE:])
+        assert metadata.num_rows == 4
+
+        assert nonzero_columns_filter(["out.electricity.total.energy_consumption"])(metadata)
+        assert not nonzero_columns_filter(["out.natural_gas.total.energy_consumption"])(metadata)
+        assert not nonzero_columns_filter(["out.not_a_column"])(metadata)
+
+    @pytest.mark.unit
+    def test_manifest(self, tmp_path):
+        """Test that the buildings in the manifest are returned from it without downloading."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=tmp_path)
+        assert processor.read_manifest(tmp_path) == {}
+
+        processor.write_manifest(tmp_path, {"1": "bldg_id-1-upgrade-0.parquet", "2": "bldg_id-2-upgrade-0.parquet"})
+        assert processor.read_manifest(tmp_path) == {"1": "bldg_id-1-upgrade-0.parquet", "2": "bldg_id-2-upgrade-0.parquet"}
+
+        # nothing is requested, since the manifest covers the buildings
+        processor.time_series_url = "http://127.0.0.1:9/timeseries_individual_buildings"
+        data_frame = pd.DataFrame({"bldg_id": [2, 1], "in.state": ["DE", "DE"]})
+        paths, building_ids = processor.process_building_time_series(data_frame, save_dir=tmp_path)
+        assert paths == [tmp_path / "bldg_id-2-upgrade-0.parquet", tmp_path / "bldg_id-1-upgrade-0.parquet"]
+        assert building_ids == ["2", "1"]
+
+        # the manifest is per upgrade
+        other_upgrade = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="1", base_dir=tmp_path)
+        assert other_upgrade.read_manifest(tmp_path) == {}
+
     @pytest.mark.integration
     def test_process_metadata_download_and_filter(self, sample_processor):
         """Test metadata downloading and filtering functionality."""
         # Run the process_metadata method
         metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
 
-        # Check that files were created
-        assert (sample_processor.base_dir / "comstock_metadata.parquet").exists()
-        expected_csv = (
+        # Check that the filtered metadata was saved
+        expected_parquet = (
             sample_processor.base_dir
-            / f"{sample_processor.state}-{sample_processor.county_name}-{sample_processor.building_type}-{sample_processor.upgrade}-selected_metadata.csv"
+            / f"{sample_processor.state}-{sample_processor.county_name}-{sample_processor.building_type}-{sample_processor.upgrade}-selected_metadata.parquet"
         )
-        assert expected_csv.exists()
+        assert expected_parquet.exists()
 
         # Check that DataFrame is returned and has expected properties
         assert isinstance(metadata_df, pd.DataFrame)
@@ -97,31 +284,37 @@ class TestComStockProcessor:
         for col in required_columns:
             assert col in metadata_df.columns
 
+    @pytest.mark.integration
+    def test_process_metadata_column_projection(self, sample_processor):
+        """Test that only the requested metadata columns are read."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir, columns=METADATA_COLUMNS)
+
+        assert list(metadata_df.columns) == METADATA_COLUMNS
+        assert len(metadata_df) > 0
+        assert all(metadata_df["in.state"] == "DE")
+        assert all(metadata_df["in.comstock_building_type"] == "SmallOffice")
+
     def test_process_metadata_caching(self, sample_processor):
         """Test that metadata caching works correctly."""
-        # First call should download
+        # First call should read the metadata from S3
         metadata_df1 = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
 
-        # Check files exist
-        parquet_file = sample_processor.base_dir / "comstock_metadata.parquet"
-        csv_file = (
+        # Check file exists
+        parquet_file = (
             sample_processor.base_dir
-            / f"{sample_processor.state}-{sample_processor.county_name}-{sample_processor.building_type}-{sample_processor.upgrade}-selected_metadata.csv"
+            / f"{sample_processor.state}-{sample_processor.county_name}-{sample_processor.building_type}-{sample_processor.upgrade}-selected_metadata.parquet"
         )
 
         assert parquet_file.exists()
-        assert csv_file.exists()
 
-        # Get modification times
+        # Get modification time
         parquet_mtime = parquet_file.stat().st_mtime
-        csv_mtime = csv_file.stat().st_mtime
 
         # Second call should use cached files
         metadata_df2 = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
 
-        # Files should not have been re-downloaded (same modification time)
+        # File should not have been recreated (same modification time)
         assert parquet_file.stat().st_mtime == parquet_mtime
-        assert csv_file.stat().st_mtime == csv_mtime
 
         # DataFrames should be identical
         pd.testing.assert_frame_equal(metadata_df1, metadata_df2)
@@ -157,6 +350,231 @@ class TestComStockProcessor:
             # Check that the file has some content
             assert Path(path).stat().st_size > 0
 
+    @pytest.mark.unit
+    def test_write_time_series_dataset_replaces_columns(self, tmp_path):
+        """Test that the columns of the files with the names of the added columns are replaced instead of duplicated."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=tmp_path)
+        path = tmp_path / "bldg_id-1-upgrade-0.parquet"
+        pd.DataFrame({"bldg_id": [1, 1], "state": ["XX", "XX"], "out.electricity.total.energy_consumption": [1.0, 2.0]}).to_parquet(path)
+        data_frame = pd.DataFrame({"bldg_id": [1], "in.state": ["DE"], "in.comstock_building_type": ["SmallOffice"]})
+
+        dataset_dir = processor.write_time_series_dataset(data_frame, [path], ["1"], tmp_path / "dataset")
+        table = ComStockProcessor.time_series_dataset(dataset_dir).to_table()
+        assert sorted(table.column_names) == sorted(
+            ["bldg_id", "state", "upgrade", "building_type", "out.electricity.total.energy_consumption"]
+        )
+        assert table.column("bldg_id").to_pylist() == ["1", "1"]
+        assert table.column("state").to_pylist() == ["DE", "DE"]
+
+    @pytest.mark.integration
+    def test_write_time_series_dataset(self, sample_processor):
+        """Test that the downloaded time series are consolidated into a partitioned dataset."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
+        small_sample = metadata_df.head(2)
+
+        timeseries_dir = sample_processor.base_dir / "time_series_data"
+        timeseries_dir.mkdir(exist_ok=True)
+
+        paths, building_ids = sample_processor.process_building_time_series(small_sample, save_dir=timeseries_dir, build_dataset=True)
+
+        dataset = ComStockProcessor.time_series_dataset(timeseries_dir / "dataset")
+        table = dataset.to_table(columns=["bldg_id", "state", "building_type"], filter=pc.field("building_type") == "SmallOffice")
+        assert table.num_rows > 0
+        assert set(table.column("bldg_id").to_pylist()) == set(building_ids)
+        assert set(table.column("state").to_pylist()) == {"DE"}
+
+    @pytest.mark.integration
+    def test_write_time_series_ipc(self, sample_processor):
+        """Test that the downloaded time series are consolidated into an Arrow IPC file per state."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
+        small_sample = metadata_df.head(2)
+
+        timeseries_dir = sample_processor.base_dir / "time_series_data"
+        timeseries_dir.mkdir(exist_ok=True)
+
+        paths, building_ids = sample_processor.process_building_time_series(small_sample, save_dir=timeseries_dir, build_ipc=True)
+
+        ipc_path = timeseries_dir / f"DE-{sample_processor.upgrade}.arrow"
+        assert ipc_path.exists()
+        table = ComStockProcessor.read_time_series_ipc(ipc_path)
+        assert set(table.column("bldg_id").to_pylist()) == set(building_ids)
+        assert table.num_rows == sum(pd.read_parquet(path).shape[0] for path in paths)
+
+    @pytest.mark.unit
+    def test_write_time_series_ipc_replaces_bldg_id(self, tmp_path):
+        """Test that a bldg_id column of the files is replaced by the added bldg_id column instead of duplicated."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=tmp_path)
+        path = tmp_path / "bldg_id-1-upgrade-0.parquet"
+        pd.DataFrame({"bldg_id": [999, 999], "out.electricity.total.energy_consumption": [1.0, 2.0]}).to_parquet(path)
+        data_frame = pd.DataFrame({"bldg_id": [1], "in.state": ["DE"]})
+
+        [ipc_path] = processor.write_time_series_ipc(data_frame, [path], ["1"], tmp_path)
+        table = ComStockProcessor.read_time_series_ipc(ipc_path)
+        assert table.column_names == ["out.electricity.total.energy_consumption", "bldg_id"]
+        assert table.column("bldg_id").to_pylist() == ["1", "1"]
+
+    @pytest.mark.integration
+    def test_iter_timeseries_batches(self, sample_processor):
+        """Test that the time series files are streamed as record batches of one dataset."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
+        small_sample = metadata_df.head(2)
+
+        timeseries_dir = sample_processor.base_dir / "time_series_data"
+        timeseries_dir.mkdir(exist_ok=True)
+
+        paths, _ = sample_processor.process_building_time_series(small_sample, save_dir=timeseries_dir)
+
+        reader = ComStockProcessor.iter_timeseries_batches(paths, batch_size=1000)
+        batches = list(reader)
+        assert all(batch.num_rows <= 1000 for batch in batches)
+        assert sum(batch.num_rows for batch in batches) == sum(pd.read_parquet(path).shape[0] for path in paths)
+
+        column = "out.electricity.total.energy_consumption"
+        table = ComStockProcessor.iter_timeseries_batches(paths, columns=[column]).read_all()
+        assert table.column_names == [column]
+
+    @pytest.mark.unit
+    def test_iter_timeseries_batches_missing_columns(self, tmp_path):
+        """Test that the requested columns that are in none of the files are read as nulls."""
+        column = "out.electricity.total.energy_consumption"
+        table = ComStockProcessor.iter_timeseries_batches([tmp_path / "missing.parquet"], columns=["timestamp", column]).read_all()
+        assert table.column_names == ["timestamp", column]
+        assert table.num_rows == 0
+
+        path = tmp_path / "bldg_id-1-upgrade-0.parquet"
+        pd.DataFrame({"timestamp": pd.date_range("2018-01-01", periods=4, freq="15min"), column: [1.0, 2.0, 3.0, 4.0]}).to_parquet(path)
+        table = ComStockProcessor.iter_timeseries_batches([path], columns=[column, "out.not_a_column"]).read_all()
+        assert table.column(column).to_pylist() == [1.0, 2.0, 3.0, 4.0]
+        assert table.column("out.not_a_column").null_count == 4
+
+    @pytest.mark.integration
+    def test_process_building_time_series_footer_filter(self, sample_processor):
+        """Test that the footers are fetched and used to decide which time series to download."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
+        small_sample = metadata_df.head(2)
+
+        timeseries_dir = sample_processor.base_dir / "footer_filter_data"
+        timeseries_dir.mkdir(exist_ok=True)
+
+        # every building uses electricity
+        electricity_filter = nonzero_columns_filter(["out.electricity.total.energy_consumption"])
+        paths, _ = sample_processor.process_building_time_series(small_sample, save_dir=timeseries_dir, footer_filter=electricity_filter)
+        assert len(paths) == len(small_sample)
+        assert len(list((timeseries_dir / "footers").iterdir())) == len(small_sample)
+
+        # no building has this column
+        missing_filter = nonzero_columns_filter(["out.not_a_column"])
+        paths, building_ids = sample_processor.process_building_time_series(
+            small_sample, save_dir=timeseries_dir, footer_filter=missing_filter
+        )
+        assert paths == []
+        assert building_ids == []
+
+    @pytest.mark.unit
+    def test_fetch_footer_failures(self, tmp_path):
+        """Test that footers which can't be requested or parsed return None instead of raising."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=tmp_path)
+        # without retries, so that the refused connection fails right away
+        processor.session = requests.Session()
+        unreachable_url = "http://127.0.0.1:9/bldg_id.parquet"
+
+        footer_path = tmp_path / "footers" / "bldg_id.parquet.footer"
+        assert processor.fetch_footer(unreachable_url, footer_path) is None
+        assert not footer_path.exists()
+
+        # a corrupt cached footer is requested again
+        footer_path.parent.mkdir()
+        footer_path.write_bytes(b"not a footer")
+        assert processor.fetch_footer(unreachable_url, footer_path) is None
+        assert not footer_path.exists()
+
+    @pytest.mark.unit
+    def test_footer_filter_corrupt_cached_file(self, tmp_path):
+        """Test that a cached file whose footer can't be read is downloaded again instead of raising."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=tmp_path)
+        # without retries, so that the refused connection fails right away
+        processor.session = requests.Session()
+        processor.time_series_url = "http://127.0.0.1:9"
+        save_path = tmp_path / "bldg_id-1-upgrade-0.parquet"
+        save_path.write_bytes(b"not a parquet file")
+
+        data_frame = pd.DataFrame({"bldg_id": [1], "in.state": ["DE"]})
+        footer_filter = nonzero_columns_filter(["out.electricity.total.energy_consumption"])
+        processor.process_building_time_series(data_frame, save_dir=tmp_path, footer_filter=footer_filter)
+
+        # the download failed too, so the corrupt file is not kept
+        assert not save_path.exists()
+        assert processor.read_manifest(tmp_path) == {}
+
+    @pytest.mark.unit
+    def test_validate_cache_removes_stale_files(self, tmp_path, monkeypatch):
+        """Test that a stale cached file is removed with its manifest entry when the footer_filter then skips the building."""
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=tmp_path)
+        save_path = tmp_path / "bldg_id-1-upgrade-0.parquet"
+        pd.DataFrame({"out.natural_gas.total.energy_consumption": [0.0, 0.0]}).to_parquet(save_path)
+        processor.write_manifest(tmp_path, {"1": save_path.name})
+
+        # without a saved ETag the version of the file is unknown, so it is stale without requesting the object
+        assert not processor.is_cached_file_current("http://127.0.0.1:9/bldg_id.parquet", save_path)
+
+        # the footer of the object online has no natural gas use, so the building is skipped
+        footer = pq.read_metadata(save_path)
+        monkeypatch.setattr(processor, "fetch_footer", lambda *_: footer)
+        data_frame = pd.DataFrame({"bldg_id": [1], "in.state": ["DE"]})
+        footer_filter = nonzero_columns_filter(["out.natural_gas.total.energy_consumption"])
+        paths, building_ids = processor.process_building_time_series(
+            data_frame, save_dir=tmp_path, footer_filter=footer_filter, validate_cache=True
+        )
+        assert (paths, building_ids) == ([], [])
+        assert not save_path.exists()
+        assert processor.read_manifest(tmp_path) == {}
+
+    @pytest.mark.integration
+    def test_process_building_time_series_validate_cache(self, sample_processor):
+        """Test that the cached files are downloaded again when their ETag no longer matches the object online."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
+        one_building = metadata_df.head(1)
+
+        timeseries_dir = sample_processor.base_dir / "validate_cache_data"
+        timeseries_dir.mkdir(exist_ok=True)
+
+        paths, _ = sample_processor.process_building_time_series(one_building, save_dir=timeseries_dir)
+        file_path = Path(paths[0])
+        etag_path = sample_processor.etag_path(file_path)
+        assert etag_path.exists()
+        etag = etag_path.read_text()
+
+        # the file is current, so it is not downloaded again
+        original_mtime = file_path.stat().st_mtime
+        sample_processor.process_building_time_series(one_building, save_dir=timeseries_dir, validate_cache=True)
+        assert file_path.stat().st_mtime == original_mtime
+
+        # simulate a file from an older release of the object
+        etag_path.write_text('"stale"')
+        file_path.write_bytes(b"stale")
+        sample_processor.process_building_time_series(one_building, save_dir=timeseries_dir, validate_cache=True)
+        assert etag_path.read_text() == etag
+        assert pq.read_metadata(file_path).num_rows > 0
+
+    @pytest.mark.integration
+    def test_process_building_time_series_manifest(self, sample_processor):
+        """Test that the downloaded files are recorded in the manifest and returned from it on the next run."""
+        metadata_df = sample_processor.process_metadata(save_dir=sample_processor.base_dir)
+        small_sample = metadata_df.head(2)
+
+        timeseries_dir = sample_processor.base_dir / "manifest_data"
+        timeseries_dir.mkdir(exist_ok=True)
+
+        paths, building_ids = sample_processor.process_building_time_series(small_sample, save_dir=timeseries_dir)
+        assert sample_processor.manifest_path(timeseries_dir).exists()
+        manifest = sample_processor.read_manifest(timeseries_dir)
+        assert [timeseries_dir / manifest[building_id] for building_id in building_ids] == paths
+
+        # a subset of the buildings is covered by the manifest
+        subset_paths, subset_ids = sample_processor.process_building_time_series(small_sample.tail(1), save_dir=timeseries_dir)
+        assert subset_paths == paths[1:]
+        assert subset_ids == building_ids[1:]
+
     def test_process_building_time_series_caching(self, sample_processor):
         """Test that time series file caching works correctly."""
         # Get metadata and take one building
@@ -229,6 +647,39 @@ class TestComStockProcessor:
         # Should return empty DataFrame for invalid state
         assert len(metadata_df) == 0
 
+        # The footer statistics of the metadata are cached next to the selections
+        assert (test_data_dir / "comstock_metadata.parquet.meta.json").exists()
+
+    @pytest.mark.integration
+    def test_process_metadata_from_cached_superset(self, test_data_dir):
+        """Test that a persisted selection of the whole state is filtered instead of reading the metadata again."""
+        state_processor = ComStockProcessor(state="DE", county_name="All", building_type="All", upgrade="0", base_dir=test_data_dir)
+        state_df = state_processor.process_metadata(save_dir=test_data_dir)
+
+        processor = ComStockProcessor(state="DE", county_name="All", building_type="Warehouse", upgrade="0", base_dir=test_data_dir)
+        assert processor.find_cached_superset(test_data_dir) is not None
+        metadata_df = processor.process_metadata(save_dir=test_data_dir)
+
+        assert all(metadata_df["in.comstock_building_type"] == "Warehouse")
+        assert len(metadata_df) == (state_df["in.comstock_building_type"] == "Warehouse").sum()
+
+    @pytest.mark.integration
+    def test_shared_metadata_store(self, tmp_path):
+        """Test that processors sharing a metadata store reuse the scans and the HTTP session."""
+        metadata_store = MetadataStore(tmp_path)
+        state_processor = ComStockProcessor("DE", "All", "All", "0", tmp_path, metadata_store=metadata_store)
+        office_processor = ComStockProcessor("DE", "All", "SmallOffice", "0", tmp_path, metadata_store=metadata_store)
+        assert state_processor.session is office_processor.session
+
+        state_table = metadata_store.filter(state="DE")
+        office_table = metadata_store.filter(state="DE", building_type="SmallOffice", columns=METADATA_COLUMNS)
+
+        # the second filter is covered by the first scan, so the metadata is not read again
+        assert len(metadata_store.scans) == 1
+        assert office_table.num_rows > 0
+        assert office_table.num_rows < state_table.num_rows
+        assert set(office_table.column("in.comstock_building_type").to_pylist()) == {"SmallOffice"}
+
     def test_all_state_filter(self, test_data_dir):
         """Test that 'All' state filter works and returns multiple states."""
 